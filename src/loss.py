@@ -11,5 +11,9 @@ class SoftTargetCrossEntropy(torch.nn.Module):
         super(SoftTargetCrossEntropy, self).__init__()
 
     def forward(self, x: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+        # Fast path for integer class labels (no mixup/smoothing): skips building a
+        # [B, num_classes] one-hot tensor just to reduce over it
+        if target.ndim == 1:
+            return F.cross_entropy(x, target)
         loss = torch.sum(-target * F.log_softmax(x, dim=-1), dim=-1)
         return loss.mean()